@@ -4,9 +4,17 @@ class StallTracker:
     def __init__(self, name: str, relevant_thread: int | Literal["gil"]): ...
     def go_active(self) -> None: ...
     def go_idle(self) -> None: ...
+    def tick(self) -> None: ...
     def is_active(self) -> bool: ...
     def counter_address(self) -> int: ...
     def close(self) -> None: ...
     def _leak(self) -> None: ...
 
+class TrioStallInstrumentImpl:
+    stall_tracker: StallTracker | None
+    def after_task_step(self, task: object) -> None: ...
+    def before_io_wait(self, timeout: float) -> None: ...
+    def after_io_wait(self, timeout: float) -> None: ...
+
 def stall_gil(seconds: float) -> None: ...
+def _after_fork_in_child(current_thread: int) -> None: ...
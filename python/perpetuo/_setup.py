@@ -1,51 +1,140 @@
 import os
+import signal
 import sys
 import threading
 import subprocess
 
-from ._perpetuo import StallTracker
+from ._perpetuo import StallTracker, TrioStallInstrumentImpl, _after_fork_in_child
 
 
-WATCHER: subprocess.Popen | None = None
+# Only present on CPython builds with the perpetuo GIL instrumentation patch
+_HAS_STALL_COUNTER = hasattr(sys, "_set_stall_counter")
+
+# A pid where we have posix_spawn, otherwise a Popen
+WATCHER: int | subprocess.Popen | None = None
+# The command line options WATCHER was started with, so that we can start an identical
+# watcher in forked children
+_WATCHER_ARGS: list[str] | None = None
 GIL_STALLTRACKER: StallTracker | None = None
+# Created on first call to instrument_trio(), so that we don't import trio unless
+# someone asks for it (and don't rebuild the class every time someone does).
+_TrioStallInstrument: type | None = None
+# A trio.lowlevel.RunVar recording whether we've already instrumented the current
+# run, so that calling dwim() more than once doesn't stack up duplicate instruments.
+_TRIO_INSTRUMENTED = None
 
 
 def start_watcher(
     *,
     poll_interval: float | None = None,
+    idle_poll_interval: float | None = None,
+    idle_after: float | None = None,
     alert_interval: float | None = None,
     traceback_suppress: float | None = None,
     print_locals: bool = True,
 ) -> None:
-    global WATCHER
+    global WATCHER, _WATCHER_ARGS
     if WATCHER is None:
         args = []
         if poll_interval is not None:
             args += ["--poll-interval", str(poll_interval)]
+        if idle_poll_interval is not None:
+            args += ["--idle-poll-interval", str(idle_poll_interval)]
+        if idle_after is not None:
+            args += ["--idle-after", str(idle_after)]
         if alert_interval is not None:
             args += ["--alert-interval", str(alert_interval)]
         if traceback_suppress is not None:
-            args += ["--traceback-suppress", str(alert_interval)]
+            args += ["--traceback-suppress", str(traceback_suppress)]
         if print_locals:
             args += ["--print-locals"]
         else:
             args += ["--no-print-locals"]
-        subprocess.Popen(["perpetuo", *args, "watch", str(os.getpid())])
+        WATCHER = _spawn_watcher(args)
+        _WATCHER_ARGS = args
+
+
+def _inheritable_fds() -> list[int] | None:
+    # Returns None if we can't find out
+    for fd_dir in ["/proc/self/fd", "/dev/fd"]:
+        try:
+            names = os.listdir(fd_dir)
+        except OSError:
+            continue
+        fds = []
+        for name in names:
+            fd = int(name)
+            try:
+                if fd > 2 and os.get_inheritable(fd):
+                    fds.append(fd)
+            except OSError:
+                # e.g. the fd that listdir used, which is closed by now
+                pass
+        return fds
+    return None
+
+
+def _spawn_watcher(args: list[str]) -> int | subprocess.Popen:
+    argv = ["perpetuo", *args, "watch", str(os.getpid())]
+    fds = _inheritable_fds() if hasattr(os, "posix_spawnp") else None
+    if fds is not None:
+        # subprocess may fork() the whole (possibly large) process first, which
+        # would stall the very process we're about to monitor. But like subprocess,
+        # we don't want the watcher holding our fds (e.g. listening sockets) open for
+        # as long as it lives.
+        return os.posix_spawnp(
+            argv[0],
+            argv,
+            os.environ,
+            file_actions=[(os.POSIX_SPAWN_CLOSE, fd) for fd in fds],
+        )
+    else:
+        return subprocess.Popen(argv)
 
 
 def stop_watcher() -> None:
-    global WATCHER
-    if WATCHER is not None:
+    global WATCHER, _WATCHER_ARGS
+    if isinstance(WATCHER, int):
+        try:
+            # Once someone else (e.g. a SIGCHLD handler) has reaped it, the pid could
+            # be reused by some unrelated process, so only signal it while it's still
+            # our unreaped child.
+            if os.waitpid(WATCHER, os.WNOHANG) == (0, 0):
+                os.kill(WATCHER, signal.SIGKILL)
+                os.waitpid(WATCHER, 0)
+        except ChildProcessError:
+            # Already reaped
+            pass
+        WATCHER = None
+    elif WATCHER is not None:
         WATCHER.kill()
         WATCHER.wait()
         WATCHER = None
+    _WATCHER_ARGS = None
+
+
+def _after_fork() -> None:
+    global WATCHER
+    # The child has its own private copy of the instrumentation, but our parent's
+    # watcher is still watching our parent, and isn't ours to stop. So if our parent
+    # had a watcher, we start one of our own. Plenty of children exec() some other
+    # program right away, before the new watcher gets a look at them, so we tell it
+    # to exit quietly if it finds we've turned into something uninstrumented.
+    _after_fork_in_child(threading.get_ident())
+    WATCHER = None
+    if _WATCHER_ARGS is not None:
+        WATCHER = _spawn_watcher([*_WATCHER_ARGS, "--quiet-if-uninstrumented"])
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
 
 
 def instrument_gil() -> None:
     global GIL_STALLTRACKER
     if GIL_STALLTRACKER is not None:
         return
-    if hasattr(sys, "_set_stall_counter"):
+    if _HAS_STALL_COUNTER:
         GIL_STALLTRACKER = StallTracker("GIL", "gil")
         # Conceptually, sys._set_stall_counter holds a reference to this object, so we
         # do an intentionally unbalanced incref here. In particular, this avoids the
@@ -60,52 +149,55 @@ def instrument_gil() -> None:
 
 
 def instrument_trio() -> None:
+    global _TrioStallInstrument, _TRIO_INSTRUMENTED
     import trio
 
-    class TrioStallInstrument(trio.abc.Instrument):
-        def __init__(self):
-            # We construct the tracker lazily, to make sure that we're already in Trio
-            # before it becomes active
-            self.stall_tracker: StallTracker | None = None
-
-        def _init(self):
-            assert self.stall_tracker is None
-            thread = threading.current_thread().ident
-            self.stall_tracker = StallTracker(
-                f"Trio run loop (thread {thread:#_x})", thread
-            )
-
-        def before_task_step(self, _: trio.lowlevel.Task) -> None:
-            if self.stall_tracker is None:
-                self._init()
-                # New StallTracker starts out in the "active" state, which is what we
-                # want
-            else:
-                self.stall_tracker.go_active()
-
-        def after_task_step(self, _: trio.lowlevel.Task) -> None:
-            if self.stall_tracker is None:
-                self._init()
-                assert self.stall_tracker is not None
-                # New StallTracker starts out in the "active" state, so need to toggle
-                # it
-            self.stall_tracker.go_idle()
-
-        def after_run(self) -> None:
-            self.stall_tracker.close()
-
-    trio.lowlevel.add_instrument(TrioStallInstrument())
+    if _TrioStallInstrument is None:
+
+        # The run loop only sits idle while it's blocked waiting for I/O, so that's
+        # where we go idle/active. Between task steps, we tick() to record that
+        # progress is being made. Those hooks are implemented in Rust (see
+        # TrioStallInstrumentImpl), so Trio's per-step callback never enters Python.
+        class TrioStallInstrument(TrioStallInstrumentImpl, trio.abc.Instrument):
+            __slots__ = ()
+
+            def _init(self):
+                # Called by the first hook that needs the tracker, to make sure that
+                # we're already in Trio before it becomes active.
+                assert self.stall_tracker is None
+                thread = threading.current_thread().ident
+                self.stall_tracker = StallTracker(
+                    f"Trio run loop (thread {thread:#_x})", thread
+                )
+
+            def after_run(self) -> None:
+                if self.stall_tracker is not None:
+                    # The last task step isn't followed by an I/O wait
+                    if self.stall_tracker.is_active():
+                        self.stall_tracker.go_idle()
+                    self.stall_tracker.close()
+
+        _TrioStallInstrument = TrioStallInstrument
+        _TRIO_INSTRUMENTED = trio.lowlevel.RunVar(
+            "perpetuo_instrumented", default=False
+        )
+
+    if _TRIO_INSTRUMENTED.get():
+        return
+    trio.lowlevel.add_instrument(_TrioStallInstrument())
+    _TRIO_INSTRUMENTED.set(True)
 
 
 def dwim(**kwargs) -> list[str]:
     did = []
 
-    try:
-        instrument_gil()
-    except RuntimeError:
-        pass
-    else:
-        did.append("instrumented GIL")
+    if _HAS_STALL_COUNTER:
+        try:
+            instrument_gil()
+        except RuntimeError:
+            pass
+        else:
+            did.append("instrumented GIL")
 
     if "trio" in sys.modules:
         try:
@@ -1,3 +1,9 @@
+import ctypes
+import mmap
+import os
+import signal
+import sys
+import threading
 import pytest
 import perpetuo
 import trio
@@ -14,6 +20,56 @@ def test_repeated_instantiation():
         st.close()
 
 
+def test_export_page_layout():
+    trackers = []
+    with pytest.raises(RuntimeError):
+        while True:
+            st = perpetuo.StallTracker("test", 1)
+            st.go_idle()
+            trackers.append(st)
+    try:
+        # Other trackers (the GIL's, or one leaked by an earlier test) might be holding
+        # slots too, so we go by the page header instead of what we got
+        page = trackers[0].counter_address() & ~(mmap.PAGESIZE - 1)
+        header = (ctypes.c_size_t * 5).from_address(page + 16)
+        self_address, _, capacity, counters_offset, _ = header
+        assert self_address == page
+        # The counters are a packed array of u64s, starting on a fresh cache line
+        assert counters_offset % 64 == 0
+        slots = set()
+        for st in trackers:
+            offset = st.counter_address() - page - counters_offset
+            assert offset % 8 == 0
+            assert 0 <= offset // 8 < capacity
+            slots.add(offset // 8)
+        assert len(slots) == len(trackers)
+
+        # Freed slots get reused
+        victim = trackers.pop(len(trackers) // 2)
+        victim_address = victim.counter_address()
+        victim.close()
+        st = perpetuo.StallTracker("test", 1)
+        st.go_idle()
+        trackers.append(st)
+        assert st.counter_address() == victim_address
+        with pytest.raises(RuntimeError):
+            perpetuo.StallTracker("test", 1)
+    finally:
+        for st in trackers:
+            st.close()
+
+
+def test_tick():
+    st = perpetuo.StallTracker("test", 1)
+    assert st.is_active()
+    st.tick()
+    assert st.is_active()
+    st.go_idle()
+    with pytest.raises(RuntimeError):
+        st.tick()
+    st.close()
+
+
 # Doesn't really test much without the instrumentation patch, but even on vanilla python
 # I guess it's good to check it doesn't crash
 def test_repeated_gil():
@@ -34,6 +90,201 @@ def test_repeated_trio():
         trio.run(main)
 
 
+@pytest.fixture
+def added_instruments(monkeypatch):
+    # Records every instrument passed to trio.lowlevel.add_instrument
+    instruments = []
+    real_add_instrument = trio.lowlevel.add_instrument
+
+    def add_instrument(instrument):
+        instruments.append(instrument)
+        real_add_instrument(instrument)
+
+    monkeypatch.setattr(trio.lowlevel, "add_instrument", add_instrument)
+    return instruments
+
+
+def test_trio_instrument_hooks(added_instruments):
+    counts = []
+
+    async def main():
+        perpetuo.instrument_trio()
+        await trio.lowlevel.checkpoint()
+        [instrument] = added_instruments
+        counter = ctypes.c_uint64.from_address(
+            instrument.stall_tracker.counter_address()
+        )
+        counts.append(counter.value)
+        # Goes through an I/O wait, plus a few more task steps
+        await trio.sleep(0.01)
+        counts.append(counter.value)
+
+    trio.run(main)
+
+    [instrument] = added_instruments
+    # The hooks Trio calls are the ones from the extension
+    assert type(instrument).after_task_step is (
+        perpetuo._perpetuo.TrioStallInstrumentImpl.after_task_step
+    )
+    # Active while a task is running, and it made progress in between
+    assert counts[0] % 2 == 1
+    assert counts[1] % 2 == 1
+    assert counts[1] > counts[0]
+    # after_run closed it
+    with pytest.raises(RuntimeError):
+        instrument.stall_tracker.is_active()
+
+
+def test_trio_instrumented_once_per_run(added_instruments, monkeypatch):
+    trackers = []
+
+    def make_stall_tracker(*args):
+        stall_tracker = perpetuo.StallTracker(*args)
+        trackers.append(stall_tracker)
+        return stall_tracker
+
+    monkeypatch.setattr(perpetuo._setup, "StallTracker", make_stall_tracker)
+    monkeypatch.setattr(perpetuo._setup, "start_watcher", lambda **kwargs: None)
+
+    async def main():
+        perpetuo.instrument_trio()
+        perpetuo.dwim()
+        await trio.lowlevel.checkpoint()
+
+    trio.run(main)
+    assert len(added_instruments) == 1
+    assert len(trackers) == 1
+
+    # A new run gets instrumented again
+    trio.run(main)
+    assert len(added_instruments) == 2
+    assert len(trackers) == 2
+
+
+@pytest.fixture
+def fake_watcher(tmp_path, monkeypatch):
+    # Call with the body of a shell script, which then gets run instead of the real
+    # watcher
+    def install(body):
+        script = tmp_path / "perpetuo"
+        script.write_text(f"#!/bin/sh\n{body}")
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+    return install
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="uses a shell script")
+def test_start_watcher_once(fake_watcher):
+    fake_watcher("exec sleep 60\n")
+
+    perpetuo.start_watcher()
+    try:
+        watcher = perpetuo._setup.WATCHER
+        assert watcher is not None
+        perpetuo.start_watcher()
+        assert perpetuo._setup.WATCHER == watcher
+    finally:
+        perpetuo.stop_watcher()
+    assert perpetuo._setup.WATCHER is None
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_watcher_doesnt_inherit_fds(tmp_path, fake_watcher):
+    fds_path = tmp_path / "fds"
+    fake_watcher(f"ls /proc/$$/fd > {fds_path}\nexec sleep 60\n")
+
+    r, w = os.pipe()
+    # Well above anything the shell uses for itself
+    fd = os.dup2(r, 200, inheritable=True)
+    perpetuo.start_watcher()
+    try:
+        for _ in range(100):
+            if fds_path.exists() and fds_path.read_text():
+                break
+            time.sleep(0.05)
+        fds = {int(name) for name in fds_path.read_text().split()}
+        assert fd not in fds
+    finally:
+        perpetuo.stop_watcher()
+        os.close(fd)
+        os.close(r)
+        os.close(w)
+
+
+@pytest.mark.skipif(not hasattr(os, "posix_spawnp"), reason="needs posix_spawn")
+def test_stop_watcher_already_reaped(fake_watcher, monkeypatch):
+    fake_watcher("exec sleep 60\n")
+
+    perpetuo.start_watcher()
+    watcher = perpetuo._setup.WATCHER
+    assert isinstance(watcher, int)
+    # As if the application's SIGCHLD handling got to it first, after which the pid
+    # could belong to anyone
+    os.kill(watcher, signal.SIGKILL)
+    os.waitpid(watcher, 0)
+
+    signals = []
+    monkeypatch.setattr(os, "kill", lambda *args: signals.append(args))
+    perpetuo.stop_watcher()
+    assert signals == []
+    assert perpetuo._setup.WATCHER is None
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_fork(monkeypatch):
+    spawned = []
+
+    def fake_spawn_watcher(args):
+        spawned.append((os.getpid(), args))
+        return object()
+
+    monkeypatch.setattr(perpetuo._setup, "_spawn_watcher", fake_spawn_watcher)
+    monkeypatch.setattr(perpetuo._setup, "WATCHER", None)
+    monkeypatch.setattr(perpetuo._setup, "_WATCHER_ARGS", None)
+
+    mine = perpetuo.StallTracker("this thread", threading.get_ident())
+    # Some thread that won't exist in the child
+    other = perpetuo.StallTracker("other thread", 12345)
+    counter = ctypes.c_uint64.from_address(mine.counter_address())
+    perpetuo.start_watcher(alert_interval=1)
+    [(_, parent_args)] = spawned
+    parent_watcher = perpetuo._setup.WATCHER
+    before = counter.value
+
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        try:
+            # We get a watcher of our own, configured the same way as our parent's
+            assert spawned[1:] == [
+                (os.getpid(), [*parent_args, "--quiet-if-uninstrumented"])
+            ]
+            assert perpetuo._setup.WATCHER is not parent_watcher
+            # Trackers from vanished threads go idle, our own are untouched
+            assert not other.is_active()
+            assert mine.is_active()
+            for _ in range(3):
+                mine.go_idle()
+                mine.go_active()
+            ok = True
+        finally:
+            os._exit(0 if ok else 1)
+
+    _, status = os.waitpid(pid, 0)
+    try:
+        assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+        # The child's counter updates didn't affect ours
+        assert counter.value == before
+        assert other.is_active()
+        assert len(spawned) == 1
+        assert perpetuo._setup.WATCHER is parent_watcher
+    finally:
+        for st in [mine, other]:
+            st.go_idle()
+            st.close()
+
+
 # XX FIXME: figure out how to run this test in CI without breaking everywhere else,
 # given the permission problems on macOS/Linux
 @pytest.mark.skip
@@ -1,12 +1,13 @@
 pub mod shmem;
 
-use crate::shmem::{alloc_slot, release_slot, StallTracker, ThreadHint, GIL};
+use crate::shmem::{after_fork_in_child, alloc_slot, release_slot, StallTracker, ThreadHint, GIL};
 use pyo3::exceptions::{PyRuntimeError, PyValueError};
 use pyo3::prelude::*;
+use std::sync::atomic::AtomicU64;
 
 #[pyclass(name = "StallTracker", module = "perpetuo")]
 struct PyStallTracker {
-    stall_tracker: Option<&'static mut StallTracker>,
+    stall_tracker: Option<StallTracker>,
 }
 
 #[derive(FromPyObject)]
@@ -35,7 +36,7 @@ impl ThreadHintArg {
     }
 }
 
-fn rustify(py: &PyStallTracker) -> PyResult<&&mut StallTracker> {
+fn rustify(py: &PyStallTracker) -> PyResult<&StallTracker> {
     py.stall_tracker
         .as_ref()
         .ok_or_else(|| PyRuntimeError::new_err("attempt to use closed StallTracker"))
@@ -76,13 +77,22 @@ impl PyStallTracker {
         Ok(())
     }
 
+    fn tick(&self) -> PyResult<()> {
+        let stall_tracker = rustify(&self)?;
+        if !stall_tracker.is_active() {
+            return Err(PyRuntimeError::new_err("Not active"));
+        }
+        stall_tracker.tick();
+        Ok(())
+    }
+
     fn is_active(&self) -> PyResult<bool> {
         let stall_tracker = rustify(&self)?;
         Ok(stall_tracker.is_active())
     }
 
     fn counter_address(&self) -> PyResult<usize> {
-        Ok(&rustify(&self)?.count as *const _ as usize)
+        Ok(rustify(&self)?.count as *const AtomicU64 as usize)
     }
 
     fn close(&mut self) -> PyResult<()> {
@@ -101,15 +111,76 @@ impl Drop for PyStallTracker {
     }
 }
 
+/// Base class for perpetuo's Trio instrument, so that the hooks Trio calls on every
+/// task step don't have to run any Python code. The Python subclass provides _init(),
+/// which creates the StallTracker and assigns it to .stall_tracker; we call it lazily
+/// from the first hook that needs it, to make sure we're already inside Trio.
+#[pyclass(name = "TrioStallInstrumentImpl", module = "perpetuo", subclass)]
+struct TrioStallInstrumentImpl {
+    #[pyo3(get, set)]
+    stall_tracker: Option<Py<PyStallTracker>>,
+}
+
+#[pymethods]
+impl TrioStallInstrumentImpl {
+    #[new]
+    fn new() -> Self {
+        TrioStallInstrumentImpl {
+            stall_tracker: None,
+        }
+    }
+
+    fn after_task_step(slf: &PyCell<Self>, _task: &PyAny) -> PyResult<()> {
+        if slf.borrow().stall_tracker.is_none() {
+            // New StallTracker starts out in the "active" state, which is what we
+            // want, but we still need to record the progress
+            slf.call_method0("_init")?;
+        }
+        let this = slf.borrow();
+        match &this.stall_tracker {
+            Some(stall_tracker) => stall_tracker.borrow(slf.py()).tick(),
+            None => Err(PyRuntimeError::new_err("_init didn't set stall_tracker")),
+        }
+    }
+
+    fn before_io_wait(&self, py: Python, _timeout: f64) -> PyResult<()> {
+        if let Some(stall_tracker) = &self.stall_tracker {
+            stall_tracker.borrow(py).go_idle()?;
+        }
+        Ok(())
+    }
+
+    fn after_io_wait(slf: &PyCell<Self>, _timeout: f64) -> PyResult<()> {
+        if slf.borrow().stall_tracker.is_none() {
+            // New StallTracker starts out in the "active" state, which is what we want
+            slf.call_method0("_init")?;
+            return Ok(());
+        }
+        let this = slf.borrow();
+        match &this.stall_tracker {
+            Some(stall_tracker) => stall_tracker.borrow(slf.py()).go_active(),
+            None => Err(PyRuntimeError::new_err("_init didn't set stall_tracker")),
+        }
+    }
+}
+
 /// Same as time.sleep, but it holds the GIL. Useful for testing.
 #[pyfunction]
 fn stall_gil(seconds: f64) {
     std::thread::sleep(std::time::Duration::from_secs_f64(seconds));
 }
 
+/// Called in the child after fork(), with the id of the thread that forked.
+#[pyfunction]
+fn _after_fork_in_child(current_thread: usize) {
+    after_fork_in_child(current_thread);
+}
+
 #[pymodule]
 fn _perpetuo(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_class::<PyStallTracker>()?;
+    m.add_class::<TrioStallInstrumentImpl>()?;
     m.add_function(wrap_pyfunction!(stall_gil, m)?)?;
+    m.add_function(wrap_pyfunction!(_after_fork_in_child, m)?)?;
     Ok(())
 }
@@ -15,6 +15,18 @@ struct Cli {
     /// How often we inspect the target process to check for progress.
     #[arg(long, value_name = "SECONDS", default_value = "0.05", value_parser=parse_duration)]
     poll_interval: Duration,
+    /// How often we poll once the target has been quiet for a while.
+    ///
+    /// A stall can only happen while something is active, so if none of the target's
+    /// stall trackers have been active at any poll for idle-after seconds, we back off
+    /// to this interval. As soon as we see anything active we go back to
+    /// poll-interval. The downside is that the first stall after a quiet period may be
+    /// reported up to this much later than it would be otherwise.
+    #[arg(long, value_name = "SECONDS", default_value = "0.25", value_parser=parse_duration)]
+    idle_poll_interval: Duration,
+    /// How long the target has to be quiet before we switch to idle-poll-interval.
+    #[arg(long, value_name = "SECONDS", default_value = "30.0", value_parser=parse_duration)]
+    idle_after: Duration,
     /// How long a stall is required to trigger a traceback.
     ///
     /// We only alert if we issue two polls that both see the same stall and are at
@@ -41,6 +53,12 @@ struct Cli {
     /// Print local variable values in tracebacks [default]
     #[clap(long = "print-locals", overrides_with = "print_locals")]
     _no_print_locals: bool,
+
+    /// If we can't find the target's instrumentation, exit quietly instead of with an
+    /// error. Used for watchers started in forked children, which often exec() some
+    /// other program before we get a look at them.
+    #[arg(long, hide = true)]
+    quiet_if_uninstrumented: bool,
 }
 
 fn parse_duration(s: &str) -> std::result::Result<Duration, String> {
@@ -78,7 +96,9 @@ fn watch_process(pid: u32, cli: &Cli) -> Result<()> {
         config.dump_locals = 0;
     }
     config.full_filenames = true;
-    eprintln!("Attempting to monitor pid {pid}...");
+    if !cli.quiet_if_uninstrumented {
+        eprintln!("Attempting to monitor pid {pid}...");
+    }
     // let mut proc = loop {
     //     if let Some(proc) = PerpetuoProc::new(pid, &config)? {
     //         break proc;
@@ -86,6 +106,9 @@ fn watch_process(pid: u32, cli: &Cli) -> Result<()> {
     //     std::thread::sleep(poll_interval);
     // };
     let result = PerpetuoProc::new(pid, &config);
+    if cli.quiet_if_uninstrumented && result.is_err() {
+        return Ok(());
+    }
     #[cfg(unix)]
     if let Err(err) = &result {
         if cfg!(target_os = "macos") && unsafe { libc::geteuid() } != 0 {
@@ -117,21 +140,43 @@ fn watch_process(pid: u32, cli: &Cli) -> Result<()> {
         }
     }
     let mut proc = result?;
+    let exe = proc.spy.process.exe()?;
     eprintln!("Successfully monitoring pid {pid}");
     let mut next_traceback = Instant::now();
+    let mut last_active = Instant::now();
     loop {
-        std::thread::sleep(cli.poll_interval);
+        let now = Instant::now();
+        if proc.any_active() {
+            last_active = now;
+        }
+        let poll_interval = if now.duration_since(last_active) >= cli.idle_after {
+            cli.idle_poll_interval
+        } else {
+            cli.poll_interval
+        };
+        let mut wakeup = now + poll_interval;
+        if let Some(deadline) = proc.next_alert_deadline(cli.alert_interval) {
+            wakeup = wakeup.min(deadline);
+        }
+        std::thread::sleep(wakeup.saturating_duration_since(Instant::now()));
         if let Err(err) = check_once(
             &mut proc,
             &mut next_traceback,
             cli.alert_interval,
             cli.traceback_suppress,
         ) {
-            if proc.spy.process.exe().is_err() {
-                eprintln!("Process {} has exited", pid);
-                return Ok(());
+            match proc.spy.process.exe() {
+                Err(_) => {
+                    eprintln!("Process {} has exited", pid);
+                    return Ok(());
+                }
+                // It exec()ed some other program, so there's nothing left for us to
+                // watch
+                Ok(current_exe) if current_exe != exe || !proc.still_instrumented() => {
+                    return Ok(());
+                }
+                Ok(_) => return Err(err),
             }
-            return Err(err);
         }
     }
 }
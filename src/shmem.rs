@@ -4,7 +4,7 @@ use once_cell::sync::Lazy;
 use py_spy::StackTrace;
 use remoteprocess::ProcessMemory;
 use std::{
-    mem::{align_of, size_of},
+    mem::size_of,
     sync::{
         atomic::{AtomicU64, Ordering},
         Mutex,
@@ -14,7 +14,7 @@ use std::{
 
 // Just output from secrets.token_bytes(16)
 const MAGIC: &[u8; 16] = b"\xad\xceat\x17I\xffA\xe8\xd4\xe8\nP\xb1\xfc\x86";
-const VERSION: usize = 0;
+const VERSION: usize = 2;
 
 static PAGE_SIZE: Lazy<usize> = Lazy::new(get_page_size);
 
@@ -52,12 +52,20 @@ impl ThreadHint {
     }
 }
 
+// The page is laid out as struct-of-arrays: after the header comes an array of
+// 'capacity' counters, then a table of 'capacity' SlotMetadata, both indexed by slot
+// id. The watcher reads every counter on every poll but only needs metadata once it's
+// found a stall, so this keeps the per-poll read small. Offsets are from the start of
+// the page.
 #[derive(Pod, Zeroable, Clone, Copy, Debug)]
 #[repr(C)]
 pub struct ShmemHeader {
     magic: [u8; 16],
     self_address: usize,
     version: usize,
+    capacity: usize,
+    counters_offset: usize,
+    metadata_offset: usize,
 }
 
 #[derive(Pod, Zeroable, Clone, Copy, Debug)]
@@ -75,15 +83,21 @@ pub struct StallReport {
     pub duration: Duration,
 }
 
-#[derive(Zeroable, Debug)]
-#[repr(C)]
+const CACHE_LINE: usize = 64;
+
+fn is_active(count: u64) -> bool {
+    count % 2 == 1
+}
+
+#[derive(Debug)]
 pub struct StallTracker {
+    id: usize,
     // odd: actively in use
     // even: quiescent/idle
-    pub count: AtomicU64,
-    // This is write-once, and always before 'count' first becomes odd. (And
-    // conveniently, we only need to read it when 'count' is odd.)
-    pub metadata: SlotMetadata,
+    //
+    // The slot's metadata is write-once, and always before 'count' first becomes odd.
+    // (And conveniently, we only need to read it when 'count' is odd.)
+    pub count: &'static AtomicU64,
 }
 
 impl StallTracker {
@@ -91,41 +105,122 @@ impl StallTracker {
         self.count.fetch_add(1, Ordering::Relaxed);
     }
 
+    /// Equivalent to toggling twice (going idle and immediately active again), but
+    /// as a single atomic update. Parity is unchanged, so the watcher just sees
+    /// that progress was made.
+    pub fn tick(&self) {
+        self.count.fetch_add(2, Ordering::Relaxed);
+    }
+
     pub fn is_active(&self) -> bool {
-        self.count.load(Ordering::Relaxed) % 2 == 1
+        is_active(self.count.load(Ordering::Relaxed))
+    }
+}
+
+struct ExportedSlots {
+    counters: &'static [AtomicU64],
+    metadata: &'static mut [SlotMetadata],
+    freelist: Vec<usize>,
+}
+
+// Returns a zeroed, read-write page that's never unmapped.
+#[cfg(unix)]
+fn map_exported_page() -> *mut u8 {
+    use libc::{
+        mmap, mprotect, MAP_ANON, MAP_FAILED, MAP_PRIVATE, PROT_NONE, PROT_READ, PROT_WRITE,
+    };
+    // This has to be a private mapping, so that after fork() the child gets its own
+    // copy of the counters instead of sharing them with its parent. But the watcher
+    // finds the page by looking for a mapping that's exactly one page long, and the
+    // kernel is happy to merge adjacent private mappings that have the same
+    // protection. So we fence the page with PROT_NONE guard pages on both sides.
+    unsafe {
+        let base = mmap(
+            std::ptr::null_mut(),
+            3 * *PAGE_SIZE,
+            PROT_NONE,
+            MAP_PRIVATE | MAP_ANON,
+            -1,
+            0,
+        );
+        assert!(base != MAP_FAILED, "{}", std::io::Error::last_os_error());
+        let page = (base as *mut u8).add(*PAGE_SIZE);
+        assert!(
+            mprotect(
+                page as *mut libc::c_void,
+                *PAGE_SIZE,
+                PROT_READ | PROT_WRITE
+            ) == 0,
+            "{}",
+            std::io::Error::last_os_error()
+        );
+        page
     }
 }
 
-fn create_exported_slots() -> &'static mut [StallTracker] {
+// Returns a zeroed, read-write page that's never unmapped.
+#[cfg(windows)]
+fn map_exported_page() -> *mut u8 {
     let mut page = memmap::MmapMut::map_anon(*PAGE_SIZE).unwrap();
+    let page_ptr = page.as_mut_ptr();
+    std::mem::forget(page);
+    page_ptr
+}
+
+fn create_exported_slots() -> ExportedSlots {
+    let page_ptr = map_exported_page();
+    // Safety: map_exported_page gives us a whole page that nothing else refers to
+    let page = unsafe { std::slice::from_raw_parts_mut(page_ptr, *PAGE_SIZE) };
     // anonymous mmap returns pre-zeroed pages
     assert!(page.iter().all(|b| *b == 0));
-    let page_raw_ptr = std::ptr::addr_of!(*page) as *const u8;
-    let (header_bytes, slots_bytes): (&mut [u8], &mut [u8]) =
-        page.split_at_mut(size_of::<ShmemHeader>());
+
+    // The counters start on a fresh cache line, so that writing them doesn't
+    // interfere with anything else, and we leave room to do the same for the
+    // metadata.
+    let counters_offset = round_up_to_multiple(size_of::<ShmemHeader>(), CACHE_LINE);
+    let capacity = (*PAGE_SIZE - counters_offset - CACHE_LINE)
+        / (size_of::<AtomicU64>() + size_of::<SlotMetadata>());
+    let metadata_offset = round_up_to_multiple(
+        counters_offset + capacity * size_of::<AtomicU64>(),
+        CACHE_LINE,
+    );
+    assert!(metadata_offset + capacity * size_of::<SlotMetadata>() <= *PAGE_SIZE);
+
     let header = ShmemHeader {
         magic: *MAGIC,
-        self_address: page_raw_ptr as usize,
+        self_address: page_ptr as usize,
         version: VERSION,
+        capacity,
+        counters_offset,
+        metadata_offset,
     };
-    header_bytes.copy_from_slice(bytemuck::bytes_of(&header));
-
-    // Safety: this is transmuting bare (zeroed) bytes into an array of POD objects
-    // where all-zeros is a valid bitpattern.
-    let (_, slots, _) = unsafe { slots_bytes.align_to_mut::<StallTracker>() };
-    // Safety: we're about to leak 'page', so we can cast its lifetime to 'static
-    let static_slots: &'static mut _ = unsafe { std::mem::transmute(slots) };
-    //eprintln!("set up slots in page at {page_raw_ptr:?}");
-    std::mem::forget(page);
-    static_slots
+    page[..size_of::<ShmemHeader>()].copy_from_slice(bytemuck::bytes_of(&header));
+
+    // Safety: this is transmuting bare (zeroed) bytes into arrays of POD objects
+    // where all-zeros is a valid bitpattern. Both offsets are cache-line aligned, so
+    // the pointers are suitably aligned, and the arrays don't overlap each other or
+    // the header. The page is never unmapped, so they can have 'static lifetimes.
+    let counters: &'static [AtomicU64] = unsafe {
+        std::slice::from_raw_parts(page_ptr.add(counters_offset) as *const AtomicU64, capacity)
+    };
+    let metadata: &'static mut [SlotMetadata] = unsafe {
+        std::slice::from_raw_parts_mut(page_ptr.add(metadata_offset) as *mut SlotMetadata, capacity)
+    };
+    //eprintln!("set up slots in page at {page_ptr:?}");
+    ExportedSlots {
+        counters,
+        metadata,
+        // Hand out low ids first, so the counters in use are packed together
+        freelist: (0..capacity).rev().collect(),
+    }
 }
 
-static SLOT_FREELIST: Mutex<Option<Vec<&'static mut StallTracker>>> = Mutex::new(None);
+static EXPORTED_SLOTS: Mutex<Option<ExportedSlots>> = Mutex::new(None);
 
-pub fn alloc_slot(name: &str, thread_hint: ThreadHint) -> Result<&'static mut StallTracker> {
-    let mut guard = SLOT_FREELIST.lock().unwrap();
+pub fn alloc_slot(name: &str, thread_hint: ThreadHint) -> Result<StallTracker> {
+    let mut guard = EXPORTED_SLOTS.lock().unwrap();
     if guard.is_none() {
-        *guard = Some(create_exported_slots().iter_mut().collect());
+        *guard = Some(create_exported_slots());
     }
 
     let string_to_leak = name.to_owned();
@@ -138,13 +233,18 @@ pub fn alloc_slot(name: &str, thread_hint: ThreadHint) -> Result<&'static mut St
         thread_hint,
     };
 
-    let freelist = guard.as_mut().unwrap();
+    let slots = guard.as_mut().unwrap();
 
-    let slot = freelist.pop().ok_or_else(|| {
+    let id = slots.freelist.pop().ok_or_else(|| {
         anyhow!("Ran out of stall tracker slots in the perpetuo instrumentation page")
     })?;
+    let counters: &'static [AtomicU64] = slots.counters;
+    let slot = StallTracker {
+        id,
+        count: &counters[id],
+    };
     assert!(!slot.is_active());
-    slot.metadata = metadata;
+    slots.metadata[id] = metadata;
     // Release ordering to ensure that 'metadata' update is published before the store
     // becomes visible, to maintain the invariant that out-of-process reads should never
     // see a Slot with odd count + invalid metadata.
@@ -152,24 +252,44 @@ pub fn alloc_slot(name: &str, thread_hint: ThreadHint) -> Result<&'static mut St
     Ok(slot)
 }
 
-pub fn release_slot(slot: &'static mut StallTracker) -> Result<()> {
+/// Call in the child after fork(), on the thread that called fork(). The child has
+/// its own copy of the page, but no other threads: any tracker that belonged to one of
+/// them and was active at the time would look stalled forever, so mark those idle.
+pub fn after_fork_in_child(current_thread: usize) {
+    let guard = EXPORTED_SLOTS.lock().unwrap();
+    if let Some(slots) = guard.as_ref() {
+        for (count, metadata) in slots.counters.iter().zip(slots.metadata.iter()) {
+            let thread_hint = metadata.thread_hint;
+            if is_active(count.load(Ordering::Relaxed))
+                && !thread_hint.is_gil()
+                && thread_hint.0 != current_thread
+            {
+                count.fetch_add(1, Ordering::Relaxed);
+            }
+        }
+    }
+}
+
+pub fn release_slot(slot: StallTracker) -> Result<()> {
     if slot.is_active() {
         bail!("attempt to release active StallTracker");
     }
-    let mut guard = SLOT_FREELIST.lock().unwrap();
-    let freelist = guard.as_mut().unwrap();
-    freelist.push(slot);
+    let mut guard = EXPORTED_SLOTS.lock().unwrap();
+    let slots = guard.as_mut().unwrap();
+    slots.freelist.push(slot.id);
     Ok(())
 }
 
 struct StallTrackerSnapshot {
-    stall_tracker: StallTracker,
+    count: u64,
     last_updated: Instant,
 }
 
 pub struct PerpetuoProc {
-    slots_ptr: usize,
-    slots_count: usize,
+    page_ptr: usize,
+    counters_offset: usize,
+    metadata_ptr: usize,
+    capacity: usize,
     last_updates: Vec<StallTrackerSnapshot>,
     pub spy: py_spy::PythonSpy,
 }
@@ -219,26 +339,32 @@ impl PerpetuoProc {
                             VERSION
                         );
                     }
+                    if header.counters_offset + header.capacity * size_of::<u64>() > map.size()
+                        || header.metadata_offset + header.capacity * size_of::<SlotMetadata>()
+                            > map.size()
+                    {
+                        bail!("{} instrumentation page is corrupt", env!("CARGO_PKG_NAME"));
+                    }
                     // We can use it!
-                    let align = align_of::<StallTracker>();
-                    let header_end = map.start() + size_of::<ShmemHeader>();
-                    let slots_ptr = round_up_to_multiple(header_end, align);
-                    let slots_count =
-                        (map.start() + map.size() - slots_ptr) / size_of::<StallTracker>();
-                    let slots = spy
-                        .process
-                        .copy_vec::<StallTracker>(slots_ptr, slots_count)?;
+                    let metadata_ptr = map.start() + header.metadata_offset;
+                    let counters = copy_counters(
+                        &spy.process,
+                        map.start() + header.counters_offset,
+                        header.capacity,
+                    )?;
                     let now = Instant::now();
-                    let last_updates = slots
+                    let last_updates = counters
                         .into_iter()
-                        .map(|stall_tracker| StallTrackerSnapshot {
-                            stall_tracker,
+                        .map(|count| StallTrackerSnapshot {
+                            count,
                             last_updated: now,
                         })
                         .collect();
                     return Ok(PerpetuoProc {
-                        slots_ptr,
-                        slots_count,
+                        page_ptr: map.start(),
+                        counters_offset: header.counters_offset,
+                        metadata_ptr,
+                        capacity: header.capacity,
                         last_updates,
                         spy,
                     });
@@ -253,30 +379,41 @@ impl PerpetuoProc {
 
     pub fn check_stalls(&mut self, alert_interval: Duration) -> Result<Vec<StallReport>> {
         let now = Instant::now();
-        let current_slots = self
-            .spy
-            .process
-            .copy_vec::<StallTracker>(self.slots_ptr, self.slots_count)?;
+        // We read the header along with the counters (it's right before them, so this
+        // is still a single read), to make sure that they're still there: if the
+        // target exec()s, then whatever's at this address now isn't ours.
+        let bytes = self.spy.process.copy(
+            self.page_ptr,
+            self.counters_offset + self.capacity * size_of::<u64>(),
+        )?;
+        let header: ShmemHeader = bytemuck::pod_read_unaligned(&bytes[..size_of::<ShmemHeader>()]);
+        if &header.magic != MAGIC || header.self_address != self.page_ptr {
+            bail!(
+                "{} instrumentation page has disappeared",
+                env!("CARGO_PKG_NAME")
+            );
+        }
+        let current_counters = parse_counters(&bytes[self.counters_offset..]);
 
         let mut stalls = Vec::new();
 
-        for (id, current) in current_slots.into_iter().enumerate() {
+        for (id, current) in current_counters.into_iter().enumerate() {
             let mut snapshot = &mut self.last_updates[id];
-            if current.is_active()
-                && current.count.load(Ordering::Relaxed)
-                    == snapshot.stall_tracker.count.load(Ordering::Relaxed)
-            {
+            if is_active(current) && current == snapshot.count {
                 if now.duration_since(snapshot.last_updated) >= alert_interval {
                     // stall detected!
+                    let metadata = self.spy.process.copy_struct::<SlotMetadata>(
+                        self.metadata_ptr + id * size_of::<SlotMetadata>(),
+                    )?;
                     let name = self
                         .spy
                         .process
-                        .copy(current.metadata.name_ptr, current.metadata.name_len)?;
+                        .copy(metadata.name_ptr, metadata.name_len)?;
                     let name = String::from_utf8(name)?;
                     stalls.push(StallReport {
                         id,
                         name,
-                        thread_hint: current.metadata.thread_hint,
+                        thread_hint: metadata.thread_hint,
                         duration: now.duration_since(snapshot.last_updated),
                     })
                 } else {
@@ -284,12 +421,61 @@ impl PerpetuoProc {
                     // yet... leave the snapshot alone so we can continue tracking it.
                 }
             } else {
-                snapshot.stall_tracker = current;
+                snapshot.count = current;
                 snapshot.last_updated = now;
             }
         }
         Ok(stalls)
     }
+
+    /// Whether the target still has our instrumentation page mapped where we found it.
+    /// After it exec()s, it won't.
+    pub fn still_instrumented(&self) -> bool {
+        match self.spy.process.copy_struct::<ShmemHeader>(self.page_ptr) {
+            Ok(header) => &header.magic == MAGIC && header.self_address == self.page_ptr,
+            Err(_) => false,
+        }
+    }
+
+    /// Whether any tracker was active as of the last call to check_stalls.
+    pub fn any_active(&self) -> bool {
+        // Snapshots only lag behind when a tracker is stuck in the active state, so
+        // this matches what check_stalls actually saw.
+        self.last_updates
+            .iter()
+            .any(|snapshot| is_active(snapshot.count))
+    }
+
+    /// If any tracker was active the last time we saw it change, then it might be
+    /// stalled right now, and if so check_stalls will start reporting it once
+    /// alert_interval has passed. This returns the earliest such moment that's still
+    /// in the future, so the caller can check right then instead of waiting for the
+    /// next regular poll.
+    pub fn next_alert_deadline(&self, alert_interval: Duration) -> Option<Instant> {
+        let now = Instant::now();
+        self.last_updates
+            .iter()
+            .filter(|snapshot| is_active(snapshot.count))
+            .map(|snapshot| snapshot.last_updated + alert_interval)
+            .filter(|deadline| *deadline > now)
+            .min()
+    }
+}
+
+fn copy_counters(
+    process: &remoteprocess::Process,
+    counters_ptr: usize,
+    capacity: usize,
+) -> Result<Vec<u64>> {
+    let bytes = process.copy(counters_ptr, capacity * size_of::<u64>())?;
+    Ok(parse_counters(&bytes))
+}
+
+fn parse_counters(bytes: &[u8]) -> Vec<u64> {
+    bytes
+        .chunks_exact(size_of::<u64>())
+        .map(|chunk| u64::from_ne_bytes(chunk.try_into().unwrap()))
+        .collect()
 }
 
 #[cfg(unix)]